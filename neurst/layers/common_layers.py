@@ -13,12 +13,29 @@
 # limitations under the License.
 import math
 
+import numpy
 import tensorflow as tf
 
+from neurst.layers import layer_utils
 from neurst.layers.quantization.quant_dense_layer import QuantDense
 from neurst.layers.quantization.quant_layers import QuantLayer
+from neurst.utils import compat
 from neurst.utils.activations import get_activation
 
+# The activations that keras resolves to exactly the same ops as `get_activation`.
+# Note that "gelu" is not included, because the keras one is not the tanh approximation.
+_KERAS_BUILTIN_ACTIVATIONS = ("relu", "tanh")
+
+
+def _dropout_residual(inputs, y, dropout_rate):
+    """ Applies dropout on `y` and adds the residual `inputs`, which can be
+        fused into a single kernel by XLA auto-clustering. """
+    if dropout_rate > 0.:
+        # the same as tf.nn.dropout, but written as one expression together with the residual
+        keep_mask = tf.cast(tf.random.uniform(tf.shape(y), dtype=y.dtype) >= dropout_rate, y.dtype)
+        return inputs + y * keep_mask * (1. / (1. - dropout_rate))
+    return inputs + y
+
 
 class PrePostProcessingWrapper(QuantLayer):
     """ Custom prepost processing for transformer.
@@ -58,31 +75,42 @@ class PrePostProcessingWrapper(QuantLayer):
 
     def build(self, input_shape):
         """ Creates norm layer. """
+        # Follows the global dtype policy. Under mixed precision, the gamma/beta are kept in float32
+        # and the statistics are computed in float32 internally, while the inputs/outputs stay in float16.
         self._norm_layer = tf.keras.layers.LayerNormalization(
-            epsilon=self._epsilon, dtype="float32", name="ln")
+            epsilon=self._epsilon, name="ln")
         self.add_activation_quantizer(name="ln", activation="act")
         super(PrePostProcessingWrapper, self).build(input_shape)
 
+    def _call_train(self, inputs, y):
+        return _dropout_residual(inputs, y, self._dropout_rate)
+
+    def _call_eval(self, inputs, y):
+        return _dropout_residual(inputs, y, 0.)
+
     def call(self, inputs, *args, **kwargs):
-        is_training = kwargs["is_training"]
+        # specialize on python bool so that no tf.cond is left in the graph
+        is_training = layer_utils.static_bool(kwargs["is_training"])
+        kwargs["is_training"] = is_training
+        if compat.is_tf_tensor(is_training):
+            def dropout_residual_fn(x, y):
+                return tf.cond(is_training, lambda: self._call_train(x, y), lambda: self._call_eval(x, y))
+        elif is_training:
+            dropout_residual_fn = self._call_train
+        else:
+            dropout_residual_fn = self._call_eval
         if self._pre_norm:
             # n
             y = self._norm_layer(inputs)
             y = self.quant(y, name="ln")
             # layer: self att / ffn
             y = self._layer(y, *args, **kwargs)
-            # d
-            if is_training:
-                y = tf.nn.dropout(y, rate=self._dropout_rate)
-            # a
-            return inputs + y
+            # da
+            return dropout_residual_fn(inputs, y)
         else:
             y = self._layer(inputs, *args, **kwargs)
-            # d
-            if is_training:
-                y = tf.nn.dropout(y, rate=self._dropout_rate)
-            # an
-            return self._norm_layer(inputs + y)
+            # dan
+            return self._norm_layer(dropout_residual_fn(inputs, y))
 
 
 class TransformerFFN(QuantLayer):
@@ -94,6 +122,8 @@ class TransformerFFN(QuantLayer):
                  output_size,
                  dropout_rate,
                  activation="relu",
+                 jit_compile=False,
+                 compute_dtype=None,
                  name="ffn"):
         """ Initializes Transformer FFN.
 
@@ -102,6 +132,10 @@ class TransformerFFN(QuantLayer):
             output_size: The output size.
             dropout_rate: The dropout rate.
             activation: The activation of internal layer.
+            jit_compile: Whether to compile the feedforward computation with XLA.
+                Note that XLA compiles the function once for each new input shape.
+            compute_dtype: The computation dtype of the dense layers, e.g. "bfloat16" or "float16",
+                while the weights are kept in float32. If not provided, use the global dtype policy.
             name: The name of this layer.
         """
         super(TransformerFFN, self).__init__(name=name)
@@ -109,9 +143,12 @@ class TransformerFFN(QuantLayer):
         self._filter_size = filter_size
         self._output_size = output_size
         self._activation = activation
+        self._ffn_compute_dtype = compute_dtype
         self._activation_fn = get_activation(activation)
+        self._jit_compile = jit_compile
         self._conv1 = None
         self._conv2 = None
+        self._compiled_ffn = compat.xla_function(self._ffn) if jit_compile else None
 
     def get_config(self):
         return dict(
@@ -119,22 +156,52 @@ class TransformerFFN(QuantLayer):
             output_size=self._output_size,
             dropout_rate=self._dropout_rate,
             activation=self._activation,
+            jit_compile=self._jit_compile,
+            compute_dtype=self._ffn_compute_dtype,
             name=self.name)
 
     def build(self, input_shape):
+        dense_dtype = None
+        if self._ffn_compute_dtype is not None:
+            dense_dtype = compat.mixed_precision_policy(self._ffn_compute_dtype)
         self._conv1 = QuantDense(
             units=self._filter_size,
-            activation=self._activation_fn,
+            activation=(self._activation if self._activation in _KERAS_BUILTIN_ACTIVATIONS
+                        else self._activation_fn),
             use_bias=True,
+            dtype=dense_dtype,
             name="dense1",
             activation_quantizer=self._activation)
         self._conv2 = QuantDense(
             units=self._output_size,
             activation=None,
             use_bias=True,
+            dtype=dense_dtype,
             name="dense2")
+        if self._jit_compile:
+            # Creates the variables here instead of inside the XLA-compiled function.
+            input_shape = tf.TensorShape(input_shape)
+            with tf.name_scope(self._conv1.name):
+                self._conv1.build(input_shape)
+            with tf.name_scope(self._conv2.name):
+                self._conv2.build(input_shape[:-1].concatenate([self._filter_size]))
         super(TransformerFFN, self).build(input_shape)
 
+    def _ffn(self, inputs, is_training):
+        """ The feedforward computation: dense1 -> dropout -> dense2. """
+        output = self._conv1(inputs)
+        if compat.is_tf_tensor(is_training):
+            output = tf.cond(is_training,
+                             lambda: tf.nn.dropout(output, rate=self._dropout_rate),
+                             lambda: output)
+        elif is_training:
+            output = tf.nn.dropout(output, rate=self._dropout_rate)
+        output = self._conv2(output)
+        if self._ffn_compute_dtype is not None:
+            # cast back for the residual connection
+            output = tf.cast(output, inputs.dtype)
+        return output
+
     def call(self, inputs, is_training=False):
         """ Returns the output of TransformerFFN.
 
@@ -146,11 +213,11 @@ class TransformerFFN(QuantLayer):
             Output of the feedforward network.
             tensor with shape [batch_size, length, output_size]
         """
-        output = self._conv1(inputs)
-        if is_training:
-            output = tf.nn.dropout(output, rate=self._dropout_rate)
-        output = self._conv2(output)
-        return output
+        # specialize on python bool so that no tf.cond is left in the graph
+        is_training = layer_utils.static_bool(is_training)
+        if self._jit_compile:
+            return self._compiled_ffn(inputs, is_training)
+        return self._ffn(inputs, is_training)
 
 
 class MultiHeadDenseLayer(QuantLayer):
@@ -192,6 +259,13 @@ class MultiHeadDenseLayer(QuantLayer):
         self._flatten_output_units = tf.nest.flatten(self._output_units)
         if is_output_transform:
             assert not tf.nest.is_nested(self._output_units)
+        # Whether there is only one projection, which requires no splitting or nest packing.
+        self._is_single = not tf.nest.is_nested(self._output_units)
+        # Whether the multiple projections (e.g. Q/K/V) have identical output units,
+        # so that they can be reshaped, activated and unstacked all at once.
+        self._fused_projections = (not is_output_transform
+                                   and len(self._flatten_output_units) > 1
+                                   and len(set(self._flatten_output_units)) == 1)
 
     def get_config(self):
         return dict(
@@ -236,9 +310,23 @@ class MultiHeadDenseLayer(QuantLayer):
                 shape=self.bias_shape,
                 initializer=self._bias_initializer,
                 trainable=True)
+        # The kernel is stored with the compatible shape. For the fused projections, it is
+        # viewed as [input_size, num_projections, num_heads, num_units_per_head] (the packed
+        # layout is already in this order) with a fully static shape. Otherwise the stored
+        # layout is used directly without reshaping.
+        self._static_kernel_shape = None
+        if self._fused_projections:
+            self._static_kernel_shape = [input_shape[-1], len(self._flatten_output_units), self._num_heads,
+                                         self._flatten_output_units[0] // self._num_heads]
         self.add_activation_quantizer(name="output", activation=self._activation)
         super(MultiHeadDenseLayer, self).build(input_shape)
 
+    def _multihead_shape(self, x):
+        """ Returns the shape [batch_size, length, num_heads, num_units_per_head] for
+            splitting heads of `x`, using the static batch_size/length if available
+            instead of assembling a dynamic shape. """
+        return layer_utils.static_shape_list(x)[:2] + [self._num_heads, -1]
+
     def call(self, inputs):
         """ Implements ``call()`` for MultiHeadDenseLayer.
 
@@ -252,34 +340,52 @@ class MultiHeadDenseLayer(QuantLayer):
                 num_units_per_head] per `self._output_units` when output_projection
                 is False, otherwise [batch_size, length, output_units].
         """
-        kernel = tf.cast(tf.keras.backend.reshape(self.quant_weight(self._kernel), self.kernel_shape),
-                         inputs.dtype)
+        kernel = self.quant_weight(self._kernel)
+        if self._static_kernel_shape is not None:
+            kernel = tf.reshape(kernel, self._static_kernel_shape)
+        kernel = tf.cast(kernel, inputs.dtype)
         if self._is_output_transform:
-            # a: batch
-            # b: length
-            # c: num heads
-            # d: input units per head
-            # e: num_output
-            output = tf.einsum("abcd,cde->abe", inputs, kernel)
-        else:
+            # Combines the heads by a reshape, [batch_size, length, num_heads * num_units_per_head],
+            # and then projects with the stored [num_heads * num_units_per_head, output_units] kernel
+            # by a single matmul, which avoids the transposes of a 4-D einsum.
+            input_shape = tf.shape(inputs)
+            output = tf.matmul(
+                tf.reshape(inputs, [input_shape[0], input_shape[1], self._kernel.shape[0]]), kernel)
+        elif self._fused_projections:
             # a: batch
             # b: length
             # c: input size
-            # d: total output size
-            output = tf.einsum("abc,cd->abd", inputs, kernel)
+            # k: num projections
+            # h: num heads
+            # d: output units per head
+            # The projections are placed in the leading axis, so that each of them
+            # is contiguous after unstacking.
+            output = tf.einsum("abc,ckhd->kabhd", inputs, kernel)
+            if self._use_bias:
+                output += tf.reshape(self._bias, [len(self._flatten_output_units), 1, 1, self._num_heads, -1])
+            if self._activation_fn is not None:
+                output = self._activation_fn(output)
+            output = self.quant(output, name="output")
+            return tf.nest.pack_sequence_as(self._output_units, tf.unstack(output, axis=0))
+        else:
+            # [batch_size, length, input_size] x [input_size, total_output_size], kept as a
+            # plain 3-D matmul in the row-major layout
+            output = tf.matmul(inputs, kernel)
         if self._use_bias:
-            output += self._bias
-
-        if not self._is_output_transform:
-            output = tf.split(
-                output, self._flatten_output_units,
-                axis=-1)
-            output = tf.nest.map_structure(
-                lambda x, num_units: tf.reshape(
-                    x, tf.concat([tf.shape(x)[:-1],
-                                  [self._num_heads, num_units // self._num_heads]], axis=0)),
-                output, self._flatten_output_units)
-        output = tf.nest.flatten(output)
+            output = tf.nn.bias_add(output, self._bias)
+
+        if self._is_single:
+            if not self._is_output_transform:
+                output = tf.reshape(output, self._multihead_shape(output))
+            if self._activation_fn is not None:
+                output = self._activation_fn(output)
+            return self.quant(output, name="output")
+
+        output = tf.split(
+            output, self._flatten_output_units,
+            axis=-1)
+        multihead_shape = self._multihead_shape(output[0])
+        output = [tf.reshape(x, multihead_shape) for x in output]
         if self._activation_fn is not None:
             output = tf.nest.map_structure(
                 self._activation_fn, output)
@@ -287,6 +393,23 @@ class MultiHeadDenseLayer(QuantLayer):
             lambda x: self.quant(x, name="output"), output)
         return tf.nest.pack_sequence_as(self._output_units, output)
 
+    def call_batched(self, inputs_list):
+        """ Projects a list of inputs with one single call, e.g. for the inputs of
+            several decoding steps, by concatenating them along the length axis.
+
+        Args:
+            inputs_list: A list of float tensors with the shapes as `call()`, which
+                can only differ in the length (the 2nd) dimension.
+
+        Returns:
+            A list of the projected outputs, each corresponding to the element of
+            `inputs_list` with the structure and shape as `call()`.
+        """
+        lengths = [layer_utils.static_shape_list(x)[1] for x in inputs_list]
+        outputs = tf.nest.flatten(self(tf.concat(inputs_list, axis=1)))
+        outputs = [tf.split(x, lengths, axis=1) for x in outputs]
+        return [tf.nest.pack_sequence_as(self._output_units, list(x)) for x in zip(*outputs)]
+
 
 class PositionEmbeddingWrapper(QuantLayer):
 
@@ -315,6 +438,12 @@ class PositionEmbeddingWrapper(QuantLayer):
         self._sinusoids_as_variable = sinusoids_as_variable
         assert self._timing in [None, "sinusoids", "emb"], (
             "Unknown position embedding type: \"{}\"".format(timing))
+        # The sinusoids timing signal requires the embedding to be scaled.
+        self._emb_scale = self._embedding_dim ** 0.5 if self._timing == "sinusoids" else None
+        # The functions for adding position embedding to 3-D and 2-D inputs,
+        # which are bound in `build()`.
+        self._add_timing_rank3 = None
+        self._add_timing_rank2 = None
 
     @property
     def embedding_layer(self):
@@ -336,16 +465,85 @@ class PositionEmbeddingWrapper(QuantLayer):
                     initializer=tf.random_normal_initializer(
                         mean=0., stddev=self._embedding_dim ** -0.5),
                     trainable=True)
-            elif self._timing == "sinusoids" and self._sinusoids_as_variable:
-                self._position_emb_table = self.add_weight(
-                    "weights",
-                    shape=[self._max_positions, self._embedding_dim],
-                    initializer=tf.constant_initializer(
-                        self.add_sinusoids_timing_signal(
-                            tf.zeros([1, self._max_positions, self._embedding_dim]), None).numpy()[0]),
-                    trainable=False)
+                self._add_timing_rank3 = self._add_position_emb_rank3
+                self._add_timing_rank2 = self._add_position_emb_rank2
+            elif self._timing == "sinusoids":
+                sinusoids_table = self.sinusoids_timing_signal_table(
+                    self._max_positions, self._embedding_dim)
+                if self._sinusoids_as_variable:
+                    self._position_emb_table = self.add_weight(
+                        "weights",
+                        shape=[self._max_positions, self._embedding_dim],
+                        initializer=tf.constant_initializer(sinusoids_table),
+                        trainable=False)
+                    self._add_timing_rank3 = self._add_position_emb_rank3
+                    self._add_timing_rank2 = self._add_position_emb_rank2
+                else:
+                    # lifted out of any tf.function so that it can be captured by all graphs
+                    with tf.init_scope():
+                        self._sinusoids_table = tf.constant(sinusoids_table, dtype=tf.float32)
+                    self._add_timing_rank3 = self._add_sinusoids_rank3
+                    self._add_timing_rank2 = self._add_sinusoids_rank2
         super(PositionEmbeddingWrapper, self).build(input_shape)
 
+    @staticmethod
+    def sinusoids_timing_signal_table(max_positions, channels,
+                                      min_timescale=1.0, max_timescale=1.0e4):
+        """ Pre-calculates the sinusoids timing signal of positions [0, max_positions),
+            which is the same as the signal added by `add_sinusoids_timing_signal`.
+
+        Args:
+            max_positions: The number of positions.
+            channels: The dimension of the timing signal.
+            min_timescale: a float
+            max_timescale: a float
+
+        Returns: A float32 numpy array with shape [max_positions, channels].
+        """
+        inv_timescales = PositionEmbeddingWrapper._inv_timescales(
+            channels // 2, min_timescale, max_timescale)
+        scaled_time = numpy.expand_dims(numpy.arange(max_positions), 1) * numpy.expand_dims(inv_timescales, 0)
+        signal = numpy.concatenate([numpy.sin(scaled_time), numpy.cos(scaled_time)], axis=1)
+        if channels % 2 != 0:
+            signal = numpy.pad(signal, [[0, 0], [0, 1]])
+        return signal.astype(numpy.float32)
+
+    @staticmethod
+    def _inv_timescales(num_timescales, min_timescale, max_timescale):
+        """ Returns the inverse of the geometric sequence of timescales as a numpy array. """
+        log_timescale_increment = (
+            math.log(float(max_timescale) / float(min_timescale))
+            / max(num_timescales - 1, 1))
+        return min_timescale * numpy.exp(
+            numpy.arange(num_timescales) * -log_timescale_increment)
+
+    def _add_sinusoids_rank3(self, x):
+        """ Adds the pre-calculated sinusoids timing signal to `x` with shape
+            [batch_size, length, dim], and falls back to `add_sinusoids_timing_signal`
+            for lengths beyond `max_positions`. """
+        # decides in python by the static length, which tf.get_static_value(tf.shape(x)[1]) misses in graphs
+        static_length = x.get_shape()[1]
+        if static_length is not None:
+            if static_length <= self._max_positions:
+                return x + tf.cast(self._sinusoids_table[:static_length], x.dtype)
+            return self.add_sinusoids_timing_signal(x=x, time=None)
+        length = tf.shape(x)[1]
+        return tf.cond(length <= self._max_positions,
+                       lambda: x + tf.cast(self._sinusoids_table[:length], x.dtype),
+                       lambda: self.add_sinusoids_timing_signal(x=x, time=None))
+
+    def _add_sinusoids_rank2(self, x, time):
+        """ Adds the pre-calculated sinusoids timing signal at `time` to `x` with shape
+            [batch_size, dim], and falls back to `add_sinusoids_timing_signal`
+            for positions beyond `max_positions`. """
+        if not compat.is_tf_tensor(time):
+            if time < self._max_positions:
+                return x + tf.cast(self._sinusoids_table[time], x.dtype)
+            return self.add_sinusoids_timing_signal(x=x, time=time)
+        return tf.cond(time < self._max_positions,
+                       lambda: x + tf.cast(tf.gather(self._sinusoids_table, time), x.dtype),
+                       lambda: self.add_sinusoids_timing_signal(x=x, time=time))
+
     @staticmethod
     def add_sinusoids_timing_signal(x, time, min_timescale=1.0, max_timescale=1.0e4):
         """Adds a bunch of sinusoids of different frequencies to a Tensor.
@@ -388,25 +586,35 @@ class PositionEmbeddingWrapper(QuantLayer):
             position = tf.cast(tf.range(time, time + 1), dtype=dtype)
         else:
             raise ValueError("need a Tensor with rank 2 or 3")
-        num_timescales = channels // 2
-        log_timescale_increment = (
-            math.log(float(max_timescale) / float(min_timescale))
-            / (tf.cast(num_timescales, dtype) - 1))
-        inv_timescales = min_timescale * tf.exp(
-            tf.cast(tf.range(num_timescales), dtype=dtype) * -log_timescale_increment)
+        # the timescales only depend on the static `channels`, which are constant-folded
+        inv_timescales = tf.constant(PositionEmbeddingWrapper._inv_timescales(
+            channels // 2, min_timescale, max_timescale), dtype=dtype)
         scaled_time = tf.expand_dims(position, 1) * tf.expand_dims(inv_timescales, 0)
         signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
-        signal = tf.pad(signal, [[0, 0], [0, tf.math.mod(channels, 2)]])
+        if channels % 2 != 0:
+            signal = tf.pad(signal, [[0, 0], [0, 1]])
         if x.get_shape().ndims == 3:
             signal = tf.reshape(signal, [1, length, channels])
         else:
             signal = tf.reshape(signal, [1, channels])
         return x + signal
 
+    def _add_position_emb_rank3(self, emb):
+        """ Adds the position embedding to `emb` with shape [batch_size, length, dim]. """
+        position_emb = tf.slice(self.quant(self._position_emb_table, name="weights"),
+                                [0, 0], [tf.shape(emb)[1], -1])
+        # [length, dim] broadcasts to [batch_size, length, dim]
+        return emb + position_emb
+
+    def _add_position_emb_rank2(self, emb, time):
+        """ Adds the position embedding at `time` to `emb` with shape [batch_size, dim]. """
+        position_emb = tf.gather(self.quant(self._position_emb_table, name="weights"), time)
+        # [dim] broadcasts to [batch_size, dim]
+        return emb + position_emb
+
     def call(self, inputs, time=None, **kwargs):
         emb = self._embedding_layer(inputs, **kwargs)
-        mode = kwargs.get("mode", "embedding")
-        if self._timing is None or mode != "embedding":
+        if self._add_timing_rank3 is None or kwargs.get("mode", "embedding") != "embedding":
             return emb
         assert emb.get_shape()[-1] == self._embedding_dim, (
             "The position embedding dimension should match the "
@@ -415,20 +623,13 @@ class PositionEmbeddingWrapper(QuantLayer):
         x_ndims = emb.get_shape().ndims
         if x_ndims == 2 and time is None:
             raise ValueError("\"time\" should be provided when input x has 2-dims")
-        if self._timing == "sinusoids":
-            emb *= self._embedding_dim ** 0.5
+        if x_ndims not in (2, 3):
+            raise ValueError("need a Tensor with rank 2 or 3")
+        if self._emb_scale is not None:
+            emb *= self._emb_scale
         # TO load from positional embedding from other repos, e.g. fairseq
         #     return self.add_sinusoids_timing_signal(
         #         x=emb, time=time)
-        # if self._timing == "emb":
-        if self._timing == "sinusoids" and not self._sinusoids_as_variable:
-            return self.add_sinusoids_timing_signal(x=emb, time=time)
-        if x_ndims == 2:
-            position_emb = tf.gather(self.quant(self._position_emb_table, name="weights"),
-                                     tf.convert_to_tensor(time, dtype=tf.int32))
-        elif x_ndims == 3:
-            position_emb = tf.slice(self.quant(self._position_emb_table, name="weights"),
-                                    [0, 0], [tf.shape(emb)[1], -1])
-        else:
-            raise ValueError("need a Tensor with rank 2 or 3")
-        return emb + tf.expand_dims(position_emb, axis=0)
+        if x_ndims == 3:
+            return self._add_timing_rank3(emb)
+        return self._add_timing_rank2(emb, time)
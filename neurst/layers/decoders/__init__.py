@@ -1,14 +1,15 @@
 import importlib
-import os
 
 from neurst.layers.decoders.decoder import Decoder
 from neurst.utils.registry import setup_registry
 
 build_decoder, register_decoder = setup_registry(Decoder.REGISTRY_NAME, base_class=Decoder)
 
-models_dir = os.path.dirname(__file__)
-for file in os.listdir(models_dir):
-    path = os.path.join(models_dir, file)
-    if not file.startswith('_') and not file.startswith('.') and file.endswith('.py'):
-        model_name = file[:file.find('.py')] if file.endswith('.py') else file
-        module = importlib.import_module('neurst.layers.decoders.' + model_name)
+# Modules containing the registered decoders, imported in a fixed order.
+_DECODER_MODULES = (
+    "light_convolution_decoder",
+    "transformer_decoder",
+)
+
+for model_name in _DECODER_MODULES:
+    module = importlib.import_module('neurst.layers.decoders.' + model_name)
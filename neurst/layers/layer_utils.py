@@ -91,6 +91,17 @@ def static_shape_list(tensor):
     return shape
 
 
+def static_bool(x):
+    """ Returns the python boolean value of `x` if it can be statically
+        determined (e.g. `is_training` given as a constant tensor), otherwise `x` itself. """
+    if compat.is_tf_tensor(x):
+        static_x = tf.get_static_value(x)
+        if static_x is None:
+            return x
+        return bool(static_x)
+    return x
+
+
 def static_tensorshape(tensor):
     """ Returns the static TensorShape. """
     return tf.TensorShape(tensor.get_shape().as_list())
@@ -21,7 +21,8 @@ class QuantDense(tf.keras.layers.Dense, QuantLayer):
 
     def __init__(self, activation_quantizer=None, *args, **kwargs):
         tf.keras.layers.Dense.__init__(self, *args, **kwargs)
-        QuantLayer.__init__(self, name=self.name)
+        # keep the dtype (policy) given to Dense, which is otherwise reset to the global policy
+        QuantLayer.__init__(self, name=self.name, dtype=kwargs.get("dtype", None))
         self._quant_op = None
         if activation_quantizer is not None:
             self._quant_op = self.add_activation_quantizer(self.name + "_activ", activation_quantizer)
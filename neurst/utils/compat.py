@@ -25,6 +25,8 @@ FLOAT_MIN = -1.e9
 CUSTOM_GLOBAL_FLOATX = "float32"
 
 IS_PREV_TF_2_4_0 = LooseVersion(tf.__version__) < LooseVersion("2.4")
+IS_PREV_TF_2_5_0 = LooseVersion(tf.__version__) < LooseVersion("2.5")
+IS_PREV_TF_2_9_0 = LooseVersion(tf.__version__) < LooseVersion("2.9")
 
 
 def _broadcast_global_setting(name, var):
@@ -159,3 +161,31 @@ def is_tf_tensor(x):
     if IS_PREV_TF_2_4_0:
         return isinstance(x, tf.Tensor)
     return tf.is_tensor(x)
+
+
+def mixed_precision_policy(compute_dtype):
+    """ Returns the keras dtype policy that computes in `compute_dtype`
+        while keeping the variables in float32. """
+    name = compute_dtype if compute_dtype == "float32" else "mixed_" + compute_dtype
+    if IS_PREV_TF_2_4_0:
+        from tensorflow.keras.mixed_precision import experimental as mixed_precision
+        return mixed_precision.Policy(name)
+    return tf.keras.mixed_precision.Policy(name)
+
+
+def xla_function(func):
+    """ Wraps `func` with a tf.function that is explicitly compiled by XLA.
+
+    The tf.function is traced with relaxed shapes, so that new batch sizes and lengths
+    reuse a generic Python trace. Note that XLA still compiles for each concrete shape.
+    """
+    function_kwargs = {}
+    if IS_PREV_TF_2_5_0:
+        function_kwargs["experimental_compile"] = True
+    else:
+        function_kwargs["jit_compile"] = True
+    if IS_PREV_TF_2_9_0:
+        function_kwargs["experimental_relax_shapes"] = True
+    else:
+        function_kwargs["reduce_retracing"] = True
+    return tf.function(func, **function_kwargs)
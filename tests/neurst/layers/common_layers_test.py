@@ -4,6 +4,8 @@ import tensorflow as tf
 from neurst.layers.common_layers import (MultiHeadDenseLayer, PositionEmbeddingWrapper, PrePostProcessingWrapper,
                                          TransformerFFN)
 from neurst.layers.modalities.text_modalities import WordEmbeddingSharedWeights
+from neurst.layers.quantization.quant_dense_layer import QuantDense
+from neurst.utils import compat
 
 
 def test_ffn():
@@ -23,6 +25,24 @@ def test_ffn():
             raise ValueError
 
 
+def test_ffn_compute_dtype():
+    dense_layer = QuantDense(units=3, dtype=compat.mixed_precision_policy("float16"), name="dense")
+    assert dense_layer.compute_dtype == "float16"
+    assert dense_layer.variable_dtype == "float32"
+
+    ffn_layer = TransformerFFN(4, 3, 0.1, compute_dtype="float16", name="ffn")
+    inputs = tf.convert_to_tensor([[[1, 2.]]], dtype=tf.float32)
+    output = ffn_layer(inputs)
+    assert output.dtype == inputs.dtype
+    assert output.get_shape() == tf.TensorShape([1, 1, 3])
+    for dense_layer in [ffn_layer._conv1, ffn_layer._conv2]:
+        assert dense_layer.compute_dtype == "float16"
+        assert dense_layer.variable_dtype == "float32"
+    for w in ffn_layer.trainable_weights:
+        assert w.dtype == tf.float32
+    assert ffn_layer.get_config()["compute_dtype"] == "float16"
+
+
 def test_prepost():
     layer = TransformerFFN(4, 3, 0.1, name="ffn")
     prepost_layer = PrePostProcessingWrapper(
@@ -93,6 +113,21 @@ def test_multihead_dense():
     assert numpy.sum((manual_out1.numpy() - layer_out1.numpy()) ** 2) < 1e-9
 
 
+def test_multihead_dense_call_batched():
+    num_heads = 3
+    layer = MultiHeadDenseLayer(
+        [6, 9], num_heads, use_bias=True, is_output_transform=False,
+        name="nonoutput_transform")
+    inputs_list = [tf.convert_to_tensor(numpy.random.randn(2, 1, 6), dtype=tf.float32),
+                   tf.convert_to_tensor(numpy.random.randn(2, 3, 6), dtype=tf.float32)]
+    batched_outputs = layer.call_batched(inputs_list)
+    assert len(batched_outputs) == len(inputs_list)
+    for inputs, (batched_out0, batched_out1) in zip(inputs_list, batched_outputs):
+        out0, out1 = layer(inputs)
+        assert numpy.sum((out0.numpy() - batched_out0.numpy()) ** 2) < 1e-9
+        assert numpy.sum((out1.numpy() - batched_out1.numpy()) ** 2) < 1e-9
+
+
 def test_position_embedding():
     embedding_layer = WordEmbeddingSharedWeights(
         embedding_dim=5, vocab_size=10,
@@ -169,8 +204,49 @@ def test_position_embedding():
                       + bias.numpy() - logits_for_2d.numpy()) ** 2) < 1e-9
 
 
+def test_position_embedding_sinusoids_table():
+    max_positions = 4
+    embedding_dim = 5  # odd channels
+    embedding_layer = PositionEmbeddingWrapper(
+        timing="sinusoids",
+        embedding_layer=WordEmbeddingSharedWeights(
+            embedding_dim=embedding_dim, vocab_size=10,
+            share_softmax_weights=False),
+        max_positions=max_positions)
+    inputs = tf.convert_to_tensor(numpy.random.randint(0, 10, size=(2, 7)), tf.int32)
+    _ = embedding_layer(inputs)
+    assert embedding_layer._sinusoids_table.get_shape() == tf.TensorShape([max_positions, embedding_dim])
+
+    def _expected(x, time=None):
+        emb = embedding_layer.embedding_layer(x) * embedding_dim ** 0.5
+        return PositionEmbeddingWrapper.add_sinusoids_timing_signal(emb, time).numpy()
+
+    # static lengths within and beyond max_positions
+    for length in [3, 7]:
+        assert numpy.sum((embedding_layer(inputs[:, :length]).numpy()
+                          - _expected(inputs[:, :length])) ** 2) < 1e-9
+    # dynamic lengths within and beyond max_positions
+    call_fn = tf.function(lambda x: embedding_layer(x),
+                          input_signature=[tf.TensorSpec([None, None], tf.int32)])
+    for length in [3, 7]:
+        assert numpy.sum((call_fn(inputs[:, :length]).numpy() - _expected(inputs[:, :length])) ** 2) < 1e-9
+    # tensor time, including the steps beyond max_positions
+    step_fn = tf.function(lambda x, t: embedding_layer(x, time=t),
+                          input_signature=[tf.TensorSpec([None], tf.int32),
+                                           tf.TensorSpec([], tf.int32)])
+    for time in range(7):
+        assert numpy.sum((step_fn(inputs[:, time], tf.convert_to_tensor(time, tf.int32)).numpy()
+                          - _expected(inputs[:, time], time)) ** 2) < 1e-9
+        # python time
+        assert numpy.sum((embedding_layer(inputs[:, time], time=time).numpy()
+                          - _expected(inputs[:, time], time)) ** 2) < 1e-9
+
+
 if __name__ == "__main__":
     test_ffn()
+    test_ffn_compute_dtype()
     test_prepost()
     test_multihead_dense()
+    test_multihead_dense_call_batched()
     test_position_embedding()
+    test_position_embedding_sinusoids_table()